@@ -1,35 +1,48 @@
-from fastapi import FastAPI, HTTPException, Request, UploadFile, File, Form, BackgroundTasks, status
+from fastapi import FastAPI, HTTPException, Request, BackgroundTasks, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse
-from passlib.context import CryptContext
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse
 from secrets import token_urlsafe
+from string import Template
+from urllib.parse import urlparse
 from dotenv import load_dotenv
 from typing import Dict
-from pydantic import BaseModel, EmailStr
-import re
+from pydantic import BaseModel
 import os
+import asyncio
+from contextlib import asynccontextmanager
 import logging
-from datetime import datetime, timedelta
+from cachetools import TTLCache
 from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
 from fastapi.templating import Jinja2Templates
-import psycopg2
-from psycopg2.extras import RealDictCursor, DictCursor
-from psycopg2 import errors as pg_errors
+from jinja2 import FileSystemBytecodeCache
+from psycopg2.extras import RealDictCursor
 
 # Load environment variables
 load_dotenv()
 
 # Import your user schemas and auth logic
 from schemas.user import User, LoginRequest, ForgotPasswordRequest
-from models.db import get_db_connection, create_users_table, DATABASE_URL
-from utils.auth_utils import hash_password, verify_password
+from models.db import get_db_connection, create_users_table, close_pool, execute_prepared, DATABASE_URL
+from utils.auth_utils import hash_password, verify_and_update_password
 
 # Setup logging
 logger = logging.getLogger("Vavastapak")
 logging.basicConfig(level=logging.INFO)
 
+# Ensure users table exists (opt-in so workers don't all run DDL on boot);
+# the DB pool itself opens lazily on first use and is closed on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if os.getenv("RUN_DDL") == "1":
+        create_users_table()
+    reaper = asyncio.create_task(reap_tokens_periodically())
+    yield
+    reaper.cancel()
+    close_pool()
+
 # FastAPI app instance
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # CORS for Flutter
 app.add_middleware(
@@ -40,9 +53,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Ensure users table exists
-create_users_table()
-
 # ---------- Mail Configuration ----------
 conf = ConnectionConfig(
     MAIL_USERNAME=os.getenv("MAIL_USERNAME"),
@@ -56,6 +66,24 @@ conf = ConnectionConfig(
     USE_CREDENTIALS=True,
     VALIDATE_CERTS=False,
 )
+mailer = FastMail(conf)
+
+RESET_EMAIL_BODY = Template("""
+    Hello,
+
+    Click the link below to reset your password (valid for 10 minutes):
+
+    $link
+
+    If you did not request this, ignore this email.
+
+    — Vavastapak Team
+    """)
+
+# Bound concurrent SMTP sends so a burst of resets can't exhaust connections.
+# Created lazily: on Python 3.8 a Semaphore binds to the loop current at creation.
+SMTP_MAX_CONCURRENCY = int(os.getenv("SMTP_MAX_CONCURRENCY", 8))
+smtp_semaphore = None
 
 # ---------- Email Function ----------
 async def send_email(subject: str, email_to: str, body: str, is_html: bool = False):
@@ -65,24 +93,73 @@ async def send_email(subject: str, email_to: str, body: str, is_html: bool = Fal
         body=body,
         subtype="html" if is_html else "plain",
     )
-    fm = FastMail(conf)
-    await fm.send_message(message)
+    global smtp_semaphore
+    if smtp_semaphore is None:
+        smtp_semaphore = asyncio.Semaphore(SMTP_MAX_CONCURRENCY)
+    async with smtp_semaphore:
+        await mailer.send_message(message)
 
 # ---------- Reset Token Storage ----------
-reset_tokens: Dict[str, Dict[str, any]] = {}
+# token_to_email is the single source of truth: entries expire after 10 minutes
+# and maxsize caps memory held by abandoned resets. reset_tokens only records each
+# email's latest token so it can be revoked; a stale entry there is harmless.
+RESET_TOKEN_TTL = 600
+token_to_email: Dict[str, str] = TTLCache(maxsize=10000, ttl=RESET_TOKEN_TTL)  # token -> email
+reset_tokens: Dict[str, str] = {}  # email -> latest token
+
+def discard_reset_token(email: str):
+    token = reset_tokens.pop(email, None)
+    if token:
+        token_to_email.pop(token, None)
+
+def reap_expired_tokens():
+    # TTLCache keeps entries in expiry order, so this only touches expired ones;
+    # the returned pairs let us drop matching revocation entries without a scan
+    for token, email in token_to_email.expire():
+        if reset_tokens.get(email) == token:
+            del reset_tokens[email]
+
+async def reap_tokens_periodically(interval: int = 60):
+    while True:
+        await asyncio.sleep(interval)
+        reap_expired_tokens()
 
 # ---------- Password Reset Form Rendering ----------
 templates = Jinja2Templates(directory="templates")
 
+# Persist compiled templates so new workers skip parsing them again. Without
+# JINJA_CACHE_DIR, Jinja uses its own per-user 0700 temp directory. The cache is
+# optional: setup or I/O problems disable it instead of failing startup or renders.
+class SafeBytecodeCache(FileSystemBytecodeCache):
+    def load_bytecode(self, bucket):
+        try:
+            super().load_bytecode(bucket)
+        except OSError as e:
+            logger.warning(f"Jinja bytecode cache read failed: {e}")
+
+    def dump_bytecode(self, bucket):
+        try:
+            super().dump_bytecode(bucket)
+        except OSError as e:
+            logger.warning(f"Jinja bytecode cache write failed: {e}")
+
+def build_bytecode_cache():
+    cache_dir = os.getenv("JINJA_CACHE_DIR")
+    try:
+        if cache_dir:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        return SafeBytecodeCache(cache_dir)
+    except (OSError, RuntimeError) as e:
+        logger.warning(f"Jinja bytecode cache disabled: {e}")
+        return None
+
+templates.env.bytecode_cache = build_bytecode_cache()
+
 @app.get("/reset-password", response_class=HTMLResponse)
 async def show_reset_form(request: Request, token: str):
-    for email, token_data in reset_tokens.items():
-        if token_data["token"] == token:
-            if token_data["expires"] < datetime.utcnow():
-                reset_tokens.pop(email, None)
-                return templates.TemplateResponse("token_expired.html", {"request": request})
-            return templates.TemplateResponse("reset.html", {"request": request, "token": token})
-    return templates.TemplateResponse("token_expired.html", {"request": request})
+    if token not in token_to_email:
+        return templates.TemplateResponse("token_expired.html", {"request": request})
+    return templates.TemplateResponse("reset.html", {"request": request, "token": token})
 
 # ---------- Reset Password Model ----------
 class ResetPasswordPayload(BaseModel):
@@ -106,69 +183,90 @@ def mask_db_url(db_url: str) -> str:
 @app.post("/register", status_code=status.HTTP_201_CREATED)
 def register(user: User):
     hashed_password = hash_password(user.password)
+    clash = 0
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
                 cursor.execute(
-                    "INSERT INTO users (name, email, password, mobile, role) VALUES (%s, %s, %s, %s, %s)",
+                    "INSERT INTO users (name, email, password, mobile, role) VALUES (%s, %s, %s, %s, %s) "
+                    "ON CONFLICT DO NOTHING RETURNING id",
                     (user.name, user.email, hashed_password, user.mobile, user.role)
                 )
+                created = cursor.fetchone()
+                if created is None:
+                    # Bit 1 = email taken, bit 2 = mobile taken, 4 = conflict row already gone
+                    cursor.execute(
+                        "SELECT COALESCE(bit_or((email=%s)::int + (mobile=%s)::int * 2), 0) "
+                        "FROM users WHERE email=%s OR mobile=%s",
+                        (user.email, user.mobile, user.email, user.mobile)
+                    )
+                    clash = cursor.fetchone()[0] or 4
                 conn.commit()
-        return {"message": "User registered successfully"}
-    except pg_errors.UniqueViolation as e:
-        error_msg = str(e)
-        if "email" in error_msg.lower():
-            raise HTTPException(status_code=400, detail="Email already exists")
-        elif "mobile" in error_msg.lower():
-            raise HTTPException(status_code=400, detail="Mobile number already exists")
-        else:
-            raise HTTPException(status_code=400, detail="User already exists")
     except Exception as e:
         logger.error(f"PostgreSQL Error during registration: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+    if clash & 1:
+        raise HTTPException(status_code=400, detail="Email already exists")
+    elif clash & 2:
+        raise HTTPException(status_code=400, detail="Mobile number already exists")
+    elif clash:
+        raise HTTPException(status_code=400, detail="User already exists")
+    return {"message": "User registered successfully"}
+
 # ================== LOGIN ENDPOINT ===================
 @app.post("/login")
 def login(login_request: LoginRequest):
     with get_db_connection() as conn:
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM users WHERE email=%s", (login_request.email,))
-            user = cursor.fetchone()
+        with conn.cursor() as cursor:
+            execute_prepared(cursor, "login_lookup", (login_request.email,))
+            row = cursor.fetchone()
 
-    if user is None or not verify_password(login_request.password, user["password"]):
+    if row is None:
         raise HTTPException(status_code=401, detail="Invalid email or password")
 
-    return {"message": "Login successful", "name": user["name"], "role": user["role"]}
+    password_hash, name, role = row
+    valid, new_hash = verify_and_update_password(login_request.password, password_hash)
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid email or password")
 
-# ================== FORGOT PASSWORD ENDPOINT ===================
-@app.post("/forgot-password/")
-async def forgot_password(payload: ForgotPasswordRequest, background_tasks: BackgroundTasks):
+    if new_hash:
+        # Lazily migrate bcrypt hashes to argon2id; best-effort, never fails the login
+        try:
+            update_password(login_request.email, new_hash)
+        except Exception as e:
+            logger.warning(f"Could not upgrade password hash for {login_request.email}: {e}")
+
+    return {"message": "Login successful", "name": name, "role": role}
+
+# ---------- Blocking DB helpers (async endpoints run them via threadpool) ----------
+def user_exists(email: str) -> bool:
+    with get_db_connection() as conn:
+        with conn.cursor() as cursor:
+            execute_prepared(cursor, "email_lookup", (email,))
+            return cursor.fetchone() is not None
+
+def update_password(email: str, hashed_password: str):
     with get_db_connection() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("SELECT * FROM users WHERE email=%s", (payload.email,))
-            user = cursor.fetchone()
+            cursor.execute("UPDATE users SET password=%s WHERE email=%s", (hashed_password, email))
+            conn.commit()
 
-    if not user:
+# ================== FORGOT PASSWORD ENDPOINT ===================
+@app.post("/forgot-password/")
+async def forgot_password(payload: ForgotPasswordRequest, background_tasks: BackgroundTasks):
+    if not await run_in_threadpool(user_exists, payload.email):
         raise HTTPException(status_code=404, detail="User not found")
 
     token = token_urlsafe(32)
-    expiry = datetime.utcnow() + timedelta(minutes=10)
-    reset_tokens[payload.email] = {"token": token, "expires": expiry}
+    discard_reset_token(payload.email)
+    reset_tokens[payload.email] = token
+    token_to_email[token] = payload.email
 
     reset_link = f"https://auth-setup-3v60.onrender.com/reset-password?token={token}"
 
     subject = "Reset Your Password"
-    body = f"""
-    Hello,
-
-    Click the link below to reset your password (valid for 10 minutes):
-
-    {reset_link}
-
-    If you did not request this, ignore this email.
-
-    — Vavastapak Team
-    """
+    body = RESET_EMAIL_BODY.substitute(link=reset_link)
 
     background_tasks.add_task(send_email, subject=subject, email_to=payload.email, body=body, is_html=False)
 
@@ -177,28 +275,18 @@ async def forgot_password(payload: ForgotPasswordRequest, background_tasks: Back
 # ================== RESET PASSWORD ENDPOINT ===================
 @app.post("/reset-password/", status_code=status.HTTP_200_OK)
 async def reset_password(payload: ResetPasswordPayload):
-    user_email = None
-    for email, token_data in reset_tokens.items():
-        if token_data["token"] == payload.token:
-            if token_data["expires"] < datetime.utcnow():
-                reset_tokens.pop(email, None)
-                raise HTTPException(status_code=400, detail="Token has expired")
-            user_email = email
-            break
-
-    if not user_email:
+    try:
+        user_email = token_to_email[payload.token]
+    except KeyError:
         raise HTTPException(status_code=400, detail="Invalid or expired token")
 
     if payload.new_password != payload.confirm_password:
         raise HTTPException(status_code=400, detail="Passwords do not match")
 
     try:
-        hashed_password = hash_password(payload.new_password)
-        with get_db_connection() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("UPDATE users SET password=%s WHERE email=%s", (hashed_password, user_email))
-                conn.commit()
-        reset_tokens.pop(user_email, None)
+        hashed_password = await run_in_threadpool(hash_password, payload.new_password)
+        await run_in_threadpool(update_password, user_email, hashed_password)
+        discard_reset_token(user_email)
         return {"message": "✅ Password successfully reset. You can now log in."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error updating password: {str(e)}")
@@ -221,7 +309,7 @@ def delete_all_users():
     try:
         with get_db_connection() as conn:
             with conn.cursor() as cursor:
-                cursor.execute("DELETE FROM users")
+                cursor.execute("TRUNCATE TABLE users RESTART IDENTITY")
                 conn.commit()
         return {"message": "All users deleted successfully"}
     except Exception as e:
@@ -232,9 +320,10 @@ def delete_all_users():
 def ping():
     try:
         with get_db_connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
             return {"status": "✅ Database connected", "db_url": mask_db_url(DATABASE_URL)}
     except Exception as e:
         return {"status": "❌ Failed to connect", "error": str(e)}
 
-# Print DB URL for debugging
-print("\U0001F50D DB URL used:", mask_db_url(DATABASE_URL))
+logger.debug("DB host: %s", urlparse(DATABASE_URL).hostname)
@@ -1,27 +1,35 @@
+from typing import Optional, Tuple
 from passlib.context import CryptContext
 from passlib.exc import UnknownHashError
 
 # Initialize CryptContext for password hashing and verification
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# New hashes use argon2id; existing bcrypt hashes still verify and get upgraded on login
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    default="argon2",
+    deprecated=["bcrypt"],
+    argon2__time_cost=2,
+    argon2__memory_cost=64 * 1024,
+    argon2__parallelism=2,
+)
 
 def hash_password(password: str) -> str:
     """
-    Hash a password using bcrypt algorithm.
+    Hash a password using the default (argon2id) algorithm.
     :param password: Plain text password
     :return: Hashed password
     """
     return pwd_context.hash(password)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+def verify_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
     """
-    Verify if a plain password matches the hashed password.
-    Gracefully handles invalid hash formats.
+    Verify a password and, if its hash is deprecated or uses outdated costs, rehash it.
     :param plain_password: Plain text password
     :param hashed_password: Hashed password
-    :return: True if passwords match, False otherwise
+    :return: (True if passwords match, new hash to store or None)
     """
     try:
-        return pwd_context.verify(plain_password, hashed_password)
+        return pwd_context.verify_and_update(plain_password, hashed_password)
     except UnknownHashError:
-        # The hash is not a valid bcrypt hash
-        return False
+        # The hash is not a valid argon2 or bcrypt hash
+        return False, None